@@ -0,0 +1,213 @@
+"""Run `~libtovid.cli.Command` and `~libtovid.cli.Pipe` objects from an
+:mod:`asyncio` event loop (Python 3 only).
+
+This module does the work behind `Command.run_async`, `Command.wait_async`,
+`Command.aiter_output`, `Command.aiter_errors`, `Pipe.run_async` and
+`Pipe.wait_async`; use those methods rather than calling it directly. Since
+every process is watched by the event loop, any number of them may be run
+and followed at once without polling, or a thread per process.
+
+Output is captured just as `Command.run` does, within ``max_capture``.
+"""
+
+__all__ = [
+    'run_command',
+    'wait_command',
+    'iter_lines',
+    'run_pipe',
+    'wait_pipe',
+]
+
+import os
+import sys
+import asyncio
+
+from libtovid.cli import ProgramNotFound, _Capture, _LineSplitter, _copy, \
+     _is_fd
+
+
+async def run_command(cmd, capture=False, background=False, silent=False,
+                      max_capture=None):
+    """Run a `Command`; see `Command.run_async`.
+    """
+    if not silent:
+        cmd._announce()
+    cmd.max_capture = max_capture
+    pipe = asyncio.subprocess.PIPE if capture else None
+    await _start(cmd, None, pipe, pipe)
+    if not background:
+        return await wait_command(cmd)
+
+
+async def wait_command(cmd):
+    """Wait for a `Command` started by `run_command`; see
+    `Command.wait_async`.
+    """
+    # Read whatever isn't being read by iter_lines, so a full pipe
+    # can't block the command
+    for name in cmd._captures:
+        _claim(cmd, name)
+    readers = [task for task in cmd._readers.values() if task]
+    try:
+        await asyncio.gather(*readers)
+        result = await cmd.proc.wait()
+    except asyncio.CancelledError:
+        if cmd.proc.returncode is None:
+            cmd.kill()
+        raise
+    if 'stdout' in cmd._captures:
+        cmd.output = cmd._captures['stdout'].getvalue()
+    if 'stderr' in cmd._captures:
+        cmd.error = cmd._captures['stderr'].getvalue()
+    return result
+
+
+async def iter_lines(cmd, name, other):
+    """Yield each line of the ``name`` stream ('stdout' or 'stderr') of a
+    `Command` started by `run_command`, reading the ``other`` stream in the
+    background meanwhile; see `Command.aiter_output`.
+    """
+    if name not in cmd._captures or name in cmd._readers:
+        return
+    cmd._readers[name] = None
+    _claim(cmd, other)
+    splitter = _LineSplitter()
+    async for data in _read(cmd._captures[name], getattr(cmd.proc, name)):
+        for line in splitter.feed(data):
+            yield line
+    for line in splitter.close():
+        yield line
+
+
+async def run_pipe(pipe, capture=False, background=False):
+    """Run a `Pipe`; see `Pipe.run_async`.
+    """
+    pipe.output = ''
+    pipe.returncodes = []
+    pipe._copiers = []
+    loop = asyncio.get_event_loop()
+    for cmd in pipe.commands:
+        cmd.proc = None
+    prev_stdout = None
+    for cmd in pipe.commands:
+        tee_files = [name for tee_cmd, name in pipe._tees if tee_cmd is cmd]
+        # Connect each command to the next with an OS pipe; the read end is
+        # the next command's, so we never see the data passing through
+        if cmd is pipe.commands[-1]:
+            read_end = None
+            target = asyncio.subprocess.PIPE if capture else None
+        else:
+            read_end, target = os.pipe()
+        stdout, source = target, None
+        if tee_files and target is not asyncio.subprocess.PIPE:
+            # Copy the output to its destination and the tee files
+            source, stdout = os.pipe()
+            if target is None:
+                target = os.dup(sys.stdout.fileno())
+        try:
+            await _start(cmd, prev_stdout, stdout, None)
+        except ProgramNotFound:
+            for fd in (read_end, source):
+                if fd is not None:
+                    os.close(fd)
+            if source is not None:
+                os.close(target)
+            # Don't leave the commands before it running
+            started = [cmd for cmd in pipe.commands if cmd.proc]
+            for cmd in started:
+                cmd.kill()
+            await asyncio.gather(*[cmd.proc.wait() for cmd in started])
+            raise
+        finally:
+            # The children have their own copies now
+            if prev_stdout is not None:
+                os.close(prev_stdout)
+            if _is_fd(stdout):
+                os.close(stdout)
+        if tee_files and source is None:
+            # Captured output goes to the tees as it is read
+            cmd._captures['stdout'].tees = await loop.run_in_executor(
+                None, _open_tees, tee_files)
+        elif tee_files:
+            pipe._copiers.append(loop.run_in_executor(
+                None, _tee_copy, source, target, tee_files))
+        prev_stdout = read_end
+    if not background:
+        return await wait_pipe(pipe)
+
+
+async def wait_pipe(pipe):
+    """Wait for every command in a `Pipe` started by `run_pipe`, and return
+    the exit status of the last one; see `Pipe.wait_async`. The status of
+    each command is put in `Pipe.returncodes`.
+    """
+    results = await asyncio.gather(*[wait_command(cmd)
+                                     for cmd in pipe.commands])
+    await asyncio.gather(*pipe._copiers)
+    pipe.returncodes = list(results)
+    return results[-1]
+
+
+def _open_tees(names):
+    """Open each of the files (or named pipes) ``names`` to tee output to.
+    Run in an executor, as opening a named pipe waits for its reader.
+    """
+    return [open(name, 'wb') for name in names]
+
+
+def _tee_copy(source, target, names):
+    """Copy everything from ``source`` to ``target`` and the files
+    ``names``; see `libtovid.cli._copy`. Run in an executor.
+    """
+    _copy(source, target, _open_tees(names))
+
+
+async def _start(cmd, stdin, stdout, stderr):
+    """Start the process for ``cmd``, with the given stream redirections.
+    """
+    cmd.output = ''
+    cmd.error = ''
+    try:
+        cmd.proc = await asyncio.create_subprocess_exec(
+            cmd.program, *cmd.args, stdin=stdin, stdout=stdout, stderr=stderr)
+    except OSError:
+        raise ProgramNotFound("Program '%s' not found." % cmd.program)
+    # Keep track of any streams piped back to us, and who is reading them
+    cmd._captures = {}
+    cmd._readers = {}
+    for name in ('stdout', 'stderr'):
+        if getattr(cmd.proc, name) is not None:
+            cmd._captures[name] = _Capture(cmd.max_capture, cmd.program)
+
+
+def _claim(cmd, name):
+    """Start a task reading the ``name`` stream of ``cmd`` into its capture,
+    unless it is not piped back to us or is already being read.
+    """
+    if name not in cmd._captures or name in cmd._readers:
+        return
+    cmd._readers[name] = asyncio.ensure_future(
+        _drain(cmd._captures[name], getattr(cmd.proc, name)))
+
+
+async def _read(capture, stream):
+    """Yield (and capture) chunks of data from ``stream`` as they arrive,
+    until end of file.
+    """
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        capture.write(data)
+        yield data
+    if capture.spill:
+        capture.spill.close()
+    for tee in capture.tees:
+        tee.close()
+    capture.done = True
+
+
+async def _drain(capture, stream):
+    """Capture everything remaining in ``stream``."""
+    async for data in _read(capture, stream):
+        pass
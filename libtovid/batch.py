@@ -0,0 +1,313 @@
+"""Encode many videos with ``tovid mpg``, several at a time, from a queue that
+is kept on disk.
+
+The queue is a JSON file listing each input file, its output prefix, and how
+far it has got. It is saved every time an encode starts or finishes, so if
+the machine (or tovid) goes down part way, running the queue again picks up
+where it left off: finished files are skipped, and encodes that were running
+are started over. Failed encodes are retried a given number of times.
+
+For example::
+
+    >>> queue = EncodeQueue('videos.queue')        # doctest: +SKIP
+    >>> queue.add('/videos/one.avi', args=['-dvd', '-ntsc'])
+    ...                                             # doctest: +SKIP
+    >>> queue.add('/videos/two.avi', args=['-dvd', '-ntsc'])
+    ...                                             # doctest: +SKIP
+    >>> queue.run(jobs=2, retries=1)                # doctest: +SKIP
+    >>> print(queue.report())                       # doctest: +SKIP
+
+Each encode's output is written to a log file in a directory beside the
+queue file (``videos.queue.logs`` above). Under the ``tovid`` jobserver
+(see `libtovid.jobserver`), every encode but one waits for a token, so the
+queue never runs more than the jobs the whole ``tovid`` command may use.
+"""
+
+__all__ = [
+    'EncodeQueue',
+]
+
+import os
+import json
+import time
+import threading
+
+from libtovid import cli
+from libtovid.jobserver import Jobserver
+# Python 3 compatibility
+from libtovid import unicode
+
+# States of a queued file
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class EncodeQueue:
+    """A list of files to encode with ``tovid mpg``, saved in a file.
+    """
+    def __init__(self, filename, program=('tovid', 'mpg')):
+        """Load the queue from ``filename``, or start an empty one if the file
+        does not exist yet.
+
+            filename
+                Name of the queue file
+            program
+                The command (program and arguments) to encode with; each
+                file's arguments, ``-in`` and ``-out`` are added to it
+        """
+        self.filename = os.path.abspath(filename)
+        self.log_dir = self.filename + '.logs'
+        self.program = list(program)
+        self.items = []
+        self._lock = threading.Lock()
+        self._running = {}
+        self._stopped = False
+        self._jobserver = None
+        if os.path.exists(self.filename):
+            self.load()
+
+
+    def load(self):
+        """Read the queue from its file. Encodes that were running when it was
+        last saved (because tovid was interrupted) are put back in the queue.
+        """
+        infile = open(self.filename, 'r')
+        self.items = json.load(infile)['items']
+        infile.close()
+        for item in self.items:
+            if item['state'] == RUNNING:
+                item['state'] = PENDING
+
+
+    def save(self):
+        """Write the queue to its file. The file is replaced all at once, so
+        it is never left half written.
+        """
+        tempname = self.filename + '.tmp'
+        outfile = open(tempname, 'w')
+        json.dump({'items': self.items}, outfile, indent=1, sort_keys=True)
+        outfile.close()
+        os.rename(tempname, self.filename)
+
+
+    def add(self, infile, output=None, args=()):
+        """Add a file to the queue, and save the queue. If the file is already
+        there with other ``args``, it takes the new ones, and is encoded again
+        even if it was done (unless it is being encoded right now).
+
+            infile
+                Video file to encode
+            output
+                Output prefix for ``-out`` (default: ``infile.enc``, as
+                ``tovid disc`` uses)
+            args
+                Other arguments to encode it with
+        """
+        infile = os.path.abspath(infile)
+        output = os.path.abspath(output or infile + '.enc')
+        args = [unicode(arg) for arg in args]
+        with self._lock:
+            for item in self.items:
+                if item['input'] == infile and item['output'] == output:
+                    if item['args'] != args:
+                        item['args'] = args
+                        if item['state'] != RUNNING:
+                            item['state'] = PENDING
+                            item['attempts'] = 0
+                            item['returncode'] = None
+                            item['seconds'] = 0
+                        self.save()
+                    return
+            self.items.append({
+                'input': infile,
+                'output': output,
+                'args': args,
+                'state': PENDING,
+                'attempts': 0,
+                'returncode': None,
+                'seconds': 0,
+                'log': os.path.join(self.log_dir, '%d.log' % len(self.items)),
+            })
+            self.save()
+
+
+    def retry_failed(self):
+        """Put every failed file back in the queue, with a fresh count of
+        attempts.
+        """
+        with self._lock:
+            for item in self.items:
+                if item['state'] == FAILED:
+                    item['state'] = PENDING
+                    item['attempts'] = 0
+            self.save()
+
+
+    def run(self, jobs=1, retries=0):
+        """Encode every file still pending in the queue, ``jobs`` at a time,
+        and return ``True`` if they all succeeded.
+
+            jobs
+                How many encodes to run at once
+            retries
+                How many times to retry a failed encode
+
+        If a :exc:`KeyboardInterrupt` occurs, running encodes are killed and
+        left pending in the queue (and :exc:`KeyboardInterrupt` re-raised).
+        """
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self._stopped = False
+        self._jobserver = Jobserver()
+        workers = []
+        # The first worker runs on this process's own job; the others need
+        # a jobserver token for each encode
+        for count in range(max(1, jobs)):
+            worker = threading.Thread(target=self._work,
+                                      args=(retries, count > 0))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            # Join with a timeout, so Ctrl-C is not held up
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+            for worker in workers:
+                worker.join()
+            raise KeyboardInterrupt
+        finally:
+            self._jobserver.close()
+        return all(item['state'] == DONE for item in self.items)
+
+
+    def stop(self):
+        """Kill the running encodes, leaving them pending in the queue, and
+        start no more.
+        """
+        with self._lock:
+            self._stopped = True
+            for cmd in self._running.values():
+                if not cmd.done():
+                    cmd.kill()
+
+
+    def report(self):
+        """Return a summary of the queue, with a line for each file.
+        """
+        counts = {}
+        lines = []
+        for item in self.items:
+            counts[item['state']] = counts.get(item['state'], 0) + 1
+            line = "%-8s %s" % (item['state'], item['input'])
+            if item['attempts']:
+                line += " (%d attempt%s, %s)" % (item['attempts'],
+                    's' if item['attempts'] > 1 else '',
+                    _format_seconds(item['seconds']))
+            if item['state'] == FAILED:
+                line += "\n         see %s" % item['log']
+            lines.append(line)
+        summary = ', '.join("%d %s" % (counts.get(state, 0), state)
+                            for state in (DONE, FAILED, PENDING))
+        lines.append("Queue %s: %s" % (self.filename, summary))
+        return '\n'.join(lines)
+
+
+    def _work(self, retries, token=False):
+        """Encode pending files until there are none left (in a worker
+        thread), taking a jobserver token for each one if ``token`` is true.
+        """
+        while True:
+            if token and not self._take_token():
+                return
+            item = self._next()
+            if not item:
+                if token:
+                    self._jobserver.give()
+                return
+            start = time.time()
+            cmd = cli.Command(*self.program)
+            cmd.add(*item['args'])
+            # -noask, since nobody can answer; -overwrite what an
+            # earlier attempt left behind
+            cmd.add('-noask')
+            if item['attempts'] > 1:
+                cmd.add('-overwrite')
+            cmd.add('-in', item['input'], '-out', item['output'])
+            log = open(item['log'], 'a')
+            log.write("%s\n" % cmd)
+            log.flush()
+            returncode = None
+            try:
+                with self._lock:
+                    if not self._stopped:
+                        cmd.run_redir(None, log, log)
+                        self._running[id(item)] = cmd
+                if cmd.proc:
+                    returncode = cmd.wait()
+            except cli.ProgramNotFound as error:
+                log.write("%s\n" % error)
+                returncode = 127
+            log.close()
+            self._finish(item, returncode, time.time() - start, retries)
+            if token:
+                self._jobserver.give()
+
+
+    def _take_token(self):
+        """Wait for a jobserver token, and return ``True`` once there is one,
+        or ``False`` if the queue is stopped (or has nothing pending) first.
+        """
+        while not self._stopped and any(item['state'] == PENDING
+                                        for item in self.items):
+            if self._jobserver.take(timeout=0.5):
+                return True
+        return False
+
+
+    def _next(self):
+        """Mark the next pending item as running, save the queue, and return
+        the item (or ``None`` if there is nothing left to do).
+        """
+        with self._lock:
+            if self._stopped:
+                return None
+            for item in self.items:
+                if item['state'] == PENDING:
+                    item['state'] = RUNNING
+                    item['attempts'] += 1
+                    self.save()
+                    return item
+        return None
+
+
+    def _finish(self, item, returncode, seconds, retries):
+        """Record the result of an encode, and save the queue.
+        """
+        with self._lock:
+            self._running.pop(id(item), None)
+            item['returncode'] = returncode
+            item['seconds'] += int(seconds)
+            # makempg may split the output into several numbered files
+            directory, prefix = os.path.split(item['output'])
+            outputs = [name for name in os.listdir(directory)
+                       if name.startswith(prefix) and name.endswith('.mpg')]
+            if self._stopped:
+                item['state'] = PENDING
+            elif returncode == 0 and outputs:
+                item['state'] = DONE
+            elif item['attempts'] <= retries:
+                item['state'] = PENDING
+            else:
+                item['state'] = FAILED
+            self.save()
+
+
+def _format_seconds(seconds):
+    """Return a number of seconds as HH:MM:SS."""
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
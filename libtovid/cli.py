@@ -62,24 +62,56 @@ command is executing; you can check whether it's done like so::
 Then, as before, use `~Command.get_output` to get the output, if you need it. If
 you need to get the standard error output, use `~Command.get_errors`.
 
+To follow a long-running command's output while it runs, run it captured in the
+background and iterate over `~Command.iter_output` (or `~Command.iter_errors`
+for standard error, where ffmpeg and friends print their progress). Lines are
+yielded as soon as they are written; both ``\\n`` and ``\\r`` end a line::
+
+    >>> ffmpeg = Command('ffmpeg', '-i', 'in.avi', 'out.mpg')
+    >>> ffmpeg.run(capture=True, background=True)   # doctest: +SKIP
+    >>> for line in ffmpeg.iter_errors():           # doctest: +SKIP
+    ...     print(line)
+
+On Python 3, commands and pipes can also be run from an :mod:`asyncio` event
+loop, with no polling and no thread per process. `~Command.run_async` and
+`~Command.wait_async` return coroutines, and `~Command.aiter_output` and
+`~Command.aiter_errors` follow the output as it is written::
+
+    >>> async def encode(ffmpeg):                 # doctest: +SKIP
+    ...     await ffmpeg.run_async(capture=True, background=True)
+    ...     async for line in ffmpeg.aiter_errors():
+    ...         print(line)
+    ...     return await ffmpeg.wait_async()
+    >>> asyncio.run(encode(ffmpeg))                 # doctest: +SKIP
+
+Captured output is normally held in memory. For commands that may write a lot
+of it, pass ``max_capture`` to `~Command.run`: only that many bytes from the end
+of each stream are kept in memory, and once a stream outgrows it, all of it is
+written to a temporary file named by `~Command.output_file` (or
+`~Command.error_file`).
+
 """
 # Note: Some of the run() tests above will fail doctest.testmod(), since output
 # from Command subprocesses is not seen as real output by doctest. The current
 # workaround is to use the "doctest: +SKIP" directive (new in python 2.5).
 # For other directives see http://www.python.org/doc/lib/doctest-options.html
 
-# TODO: Make the 'capture/get_output' mechanisms able to handle large amounts
-# of output, perhaps by logging to a temporary file and/or returning an iterator
-# for lines of output, instead of a flat string.
-
 __all__ = [
     'Command',
     'Pipe',
+    'Scheduler',
+    'Job',
+    'JobCancelled',
+    'cpu_count',
 ]
 
 import subprocess
+import threading
 import signal
 import os
+import re
+import sys
+import stat
 # Small workaround for Python 3.x
 from libtovid import unicode, basestring
 
@@ -113,6 +145,8 @@ class Command:
         self.proc = None
         self.output = ''
         self.error = ''
+        self.max_capture = None
+        self._captures = {}
 
 
     def add(self, *args):
@@ -125,19 +159,25 @@ class Command:
             self.args.append(unicode(arg))
 
 
-    def run(self, capture=False, background=False, silent=False):
+    def run(self, capture=False, background=False, silent=False,
+            max_capture=None):
         """Run the command and capture or display output.
 
             capture
                 ``False`` to show command output/errors on stdout,
                 ``True`` to capture output/errors for retrieval
-                by `get_output` and `get_errors`
+                by `get_output` and `get_errors`, or line by line
+                with `iter_output` and `iter_errors`
             background
                 ``False`` to wait for command to finish running,
                 ``True`` to run process in the background
             silent
                 ``False`` to print each command as it runs,
                 ``True`` to run silently
+            max_capture
+                ``None`` to keep all captured output in memory, or
+                the number of bytes of each stream to keep; see
+                `output_file`
 
         By default, this function displays all command output, and waits
         for the program to finish running, which is usually what you'd want.
@@ -148,11 +188,9 @@ class Command:
         use `run_redir`.
         """
         if not silent:
-            print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-            print("Running command:")
-            print(unicode(self))
-            print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+            self._announce()
 
+        self.max_capture = max_capture
         if capture:
             self.run_redir(None, subprocess.PIPE, stderr=subprocess.PIPE)
         else:
@@ -161,6 +199,48 @@ class Command:
             self.wait()
 
 
+    def run_async(self, capture=False, background=False, silent=False,
+                  max_capture=None):
+        """Return a coroutine that runs the command like `run`, without
+        blocking the event loop (Python 3 only). Awaiting it returns the exit
+        status, or ``None`` if ``background=True``; in that case, follow the
+        command with `aiter_output` or `aiter_errors`, and await
+        `wait_async` for it to finish.
+
+        Once it has finished, captured output is in `get_output` and
+        `get_errors` as usual.
+        """
+        from libtovid import aiocli
+        return aiocli.run_command(self, capture, background, silent,
+                                  max_capture)
+
+
+    def wait_async(self):
+        """Return a coroutine that waits for a command started by `run_async`
+        to finish, reading any captured output meanwhile, and returns its exit
+        status. If the coroutine is cancelled, the command is killed.
+        """
+        from libtovid import aiocli
+        return aiocli.wait_command(self)
+
+
+    def aiter_output(self):
+        """Return an asynchronous iterator over the lines of output of a
+        command started by `run_async` (with ``capture=True``), like
+        `iter_output`.
+        """
+        from libtovid import aiocli
+        return aiocli.iter_lines(self, 'stdout', 'stderr')
+
+
+    def aiter_errors(self):
+        """Return an asynchronous iterator over the lines of standard error
+        output of a command started by `run_async`, like `iter_errors`.
+        """
+        from libtovid import aiocli
+        return aiocli.iter_lines(self, 'stderr', 'stdout')
+
+
     def run_redir(self, stdin=None, stdout=None, stderr=None):
         """Execute the command using the given stream redirections.
 
@@ -180,6 +260,7 @@ class Command:
         if needed.
         """
         self.output = ''
+        self.error = ''
         # Open files if string filenames were provided
         if isinstance(stdin, basestring):
             stdin = open(stdin, 'r')
@@ -190,14 +271,20 @@ class Command:
         # Run the subprocess
         try:
             self.proc = subprocess.Popen([self.program] + self.args,
-                              stdin=stdin, stdout=stdout, stderr=stderr)
+                              stdin=stdin, stdout=stdout, stderr=stderr,
+                              close_fds=True)
         except OSError:
             raise ProgramNotFound("Program '%s' not found." % self.program)
+        # Keep track of any streams piped back to us
+        self._captures = {}
+        for name in ('stdout', 'stderr'):
+            if getattr(self.proc, name) is not None:
+                self._captures[name] = _Capture(self.max_capture, self.program)
 
 
     def wait(self):
         """Wait for the command to finish running, and return the result
-        (`self.proc.returncode`).
+        (`self.proc.returncode`). Any captured output is read meanwhile.
 
         If a :exc:`KeyboardInterrupt` occurs (user pressed Ctrl-C), the
         subprocess is killed (and :exc:`KeyboardInterrupt` re-raised).
@@ -206,6 +293,9 @@ class Command:
             print("**** Can't wait(): Command is not running")
             return
         try:
+            # Read captured streams while waiting, so a full pipe
+            # can't block the command
+            self._drain()
             result = self.proc.wait()
         except KeyboardInterrupt:
             self.kill()
@@ -214,9 +304,16 @@ class Command:
 
 
     def kill(self):
-        """Abort!
+        """Abort! Does nothing if the command isn't running (once it has
+        been reaped, its pid may belong to some other process).
         """
-        os.kill(self.proc.pid, signal.SIGTERM)
+        if self.proc is None or self.done():
+            return
+        try:
+            os.kill(self.proc.pid, signal.SIGTERM)
+        except OSError:
+            # It finished since done() was asked
+            pass
         #self.proc.kill()
 
 
@@ -225,7 +322,10 @@ class Command:
         """Return ``True`` if the command is finished running; ``False``
         otherwise. Only useful if the command is run in the background.
         """
-        return self.proc.poll() != None
+        if isinstance(self.proc, subprocess.Popen):
+            return self.proc.poll() != None
+        # Started by run_async
+        return self.proc.returncode != None
 
 
     def get_output(self):
@@ -233,9 +333,15 @@ class Command:
         containing the command's output. If this command is piped into another,
         return that command's output instead. Returns an empty string if the
         command has not been run yet.
+
+        If the output outgrew ``max_capture``, only its last ``max_capture``
+        bytes are returned; the whole of it is in `output_file`.
         """
-        if self.output == '' and isinstance(self.proc, subprocess.Popen):
-            self.output = self.proc.communicate()[0]
+        if self.output == '' and 'stdout' in self._captures:
+            # A command run by run_async is waited for by wait_async
+            if isinstance(self.proc, subprocess.Popen):
+                self.wait()
+            self.output = self._captures['stdout'].getvalue()
         return self.output
 
 
@@ -243,12 +349,112 @@ class Command:
         """Wait for the command to finish running, and return a string
         containing the command's standard error output. Returns an empty
         string if the command has not been run yet.
+
+        If the errors outgrew ``max_capture``, only their last ``max_capture``
+        bytes are returned; the whole of them is in `error_file`.
         """
-        if self.error == '' and isinstance(self.proc, subprocess.Popen):
-            self.error = self.proc.communicate()[1]
+        if self.error == '' and 'stderr' in self._captures:
+            # A command run by run_async is waited for by wait_async
+            if isinstance(self.proc, subprocess.Popen):
+                self.wait()
+            self.error = self._captures['stderr'].getvalue()
         return self.error
 
 
+    def iter_output(self):
+        """Yield each line of the command's standard output (as a unicode
+        string without its line ending) as soon as it is written, until the
+        command exits. The command must have been run with ``capture=True``
+        and usually ``background=True``.
+
+        Standard error is read (and captured for `get_errors`) in the
+        background meanwhile, so the command can't block on either stream.
+        Lines are also captured for `get_output`, within ``max_capture``.
+        """
+        return self._iter_lines('stdout', 'stderr')
+
+
+    def iter_errors(self):
+        """Yield each line of the command's standard error output as soon as
+        it is written, until the command exits. This is where ffmpeg, mplex
+        and most other tools report progress. See `iter_output`.
+        """
+        return self._iter_lines('stderr', 'stdout')
+
+
+    @property
+    def output_file(self):
+        """The name of the temporary file holding all of the captured output,
+        or ``None`` if it fit within ``max_capture``. The file is left for the
+        caller to remove.
+        """
+        if 'stdout' in self._captures:
+            return self._captures['stdout'].filename
+        return None
+
+
+    @property
+    def error_file(self):
+        """The name of the temporary file holding all of the captured errors,
+        or ``None``. See `output_file`.
+        """
+        if 'stderr' in self._captures:
+            return self._captures['stderr'].filename
+        return None
+
+
+    def _iter_lines(self, name, other):
+        """Yield lines from the ``name`` stream ('stdout' or 'stderr'),
+        draining the ``other`` stream in a background thread.
+        """
+        if name not in self._captures:
+            return
+        drainer = self._drain_thread(other)
+        for line in _split_lines(self._captures[name].read_from(
+                                 getattr(self.proc, name))):
+            yield line
+        if drainer:
+            drainer.join()
+        self.wait()
+
+
+    def _drain_thread(self, name):
+        """Start and return a thread reading the ``name`` stream into its
+        capture, or return ``None`` if it is not piped back to us.
+        """
+        if name not in self._captures:
+            return None
+        capture = self._captures[name]
+        stream = getattr(self.proc, name)
+        thread = threading.Thread(target=capture.drain, args=(stream,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+    def _drain(self):
+        """Read all remaining output and errors into their captures
+        (like ``Popen.communicate``).
+        """
+        if not self._captures:
+            return
+        if self.proc.stdin:
+            self.proc.stdin.close()
+        drainer = self._drain_thread('stderr')
+        if 'stdout' in self._captures:
+            self._captures['stdout'].drain(self.proc.stdout)
+        if drainer:
+            drainer.join()
+
+
+    def _announce(self):
+        """Print the command about to be run."""
+        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+        print("Running command:")
+        print(unicode(self))
+        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+
+
     def __str__(self):
         """Return a string representation of the Command, as it would look if
         run in a command-line shell.
@@ -273,6 +479,12 @@ class Command:
 
 class Pipe:
     """Several `Command` objects, each having its output piped into the next.
+
+    Each command's output goes straight to the next command through an OS
+    pipe, as in a shell; none of it passes through Python unless it is
+    captured, or copied to a file with `tee`. Every command is waited for,
+    and each one's exit status is kept in `returncodes` (like bash's
+    ``PIPESTATUS``).
     """
     def __init__(self, *commands):
         """Create a new Pipe containing all the given Commands."""
@@ -281,6 +493,14 @@ class Pipe:
             self.add(cmd)
         self.proc = None
         self.output = ''
+        self.returncodes = []
+        self._tees = []
+        self._starters = []
+        self._copiers = []
+        self._fifos = []
+        self._caller_fds = ()
+        self._killed = False
+        self._lock = threading.Lock()
 
 
     def add(self, *commands):
@@ -289,6 +509,21 @@ class Pipe:
             self.commands.append(cmd)
 
 
+    def tee(self, command, filename):
+        """Also write everything ``command`` outputs to ``filename``, as
+        ``command | tee filename | ...`` would in a shell, but without
+        running ``tee``.
+
+            command
+                One of the Commands in the pipeline
+            filename
+                File (or named pipe) to write a copy of its output to
+        """
+        if command not in self.commands:
+            raise ValueError("'%s' is not in this pipeline" % command)
+        self._tees.append((command, filename))
+
+
     def run(self, capture=False, background=False):
         """Run all Commands in the pipeline, doing appropriate stream
         redirection for piping.
@@ -296,25 +531,130 @@ class Pipe:
             capture
                 ``False`` to show pipeline output on stdout,
                 ``True`` to capture output for retrieval by `get_output`
+            background
+                ``False`` to wait for every command to finish,
+                ``True`` to run the pipeline in the background
 
+        """
+        if capture:
+            self.run_redir(None, subprocess.PIPE)
+        else:
+            self.run_redir(None, None)
+        if not background:
+            self.wait()
+
+
+    def run_redir(self, stdin=None, stdout=None):
+        """Execute the pipeline using the given stream redirections, and
+        return without waiting for it.
+
+            stdin
+                Filename or `file` object for the first command to read from
+            stdout
+                Filename or `file` object for the last command to write to,
+                or ``subprocess.PIPE`` to capture it for `get_output`
+
+        Use ``None`` for regular system stdin/stdout. Either filename may be
+        a named pipe (FIFO); the command using it is started in the
+        background once the program at the other end opens it, so the rest
+        of the pipeline (and the caller) is not held up meanwhile.
         """
         self.output = ''
-        prev_stdout = None
-        # Run each command, piping to the next
+        self.returncodes = []
+        self._starters = []
+        self._copiers = []
+        self._fifos = []
+        # Descriptors the caller gave us are theirs to close, not ours
+        self._caller_fds = [fd for fd in (stdin, stdout) if _is_fd(fd)]
+        self._killed = False
         for cmd in self.commands:
-            # If this is not the last command, pipe into the next one
-            if cmd != self.commands[-1]:
-                cmd.run_redir(prev_stdout, subprocess.PIPE, None)
-                prev_stdout = cmd.proc.stdout
-            # Last command in pipeline; direct output appropriately
-            else:
-                if capture:
-                    cmd.run_redir(prev_stdout, subprocess.PIPE, None)
+            cmd.proc = None
+        cmd_in, next_in = stdin, None
+        try:
+            for cmd in self.commands:
+                if cmd is self.commands[-1]:
+                    next_in, cmd_out = None, stdout
                 else:
-                    cmd.run_redir(prev_stdout, None, None)
-                # Wait for last command to finish
-                if not background:
+                    next_in, cmd_out = os.pipe()
+                self._start(cmd, cmd_in, cmd_out)
+                cmd_in = next_in
+        except:
+            # The failed command's end of its pipe was closed; close ours
+            if _is_fd(next_in):
+                os.close(next_in)
+            self.kill()
+            raise
+
+
+    def wait(self):
+        """Wait for every command in the pipeline to finish, and return the
+        exit status of the last one. The status of each command is put in
+        `returncodes`; a command that was never started has ``None``.
+
+        If a :exc:`KeyboardInterrupt` occurs (user pressed Ctrl-C), the
+        pipeline is killed (and :exc:`KeyboardInterrupt` re-raised).
+        """
+        try:
+            for thread in self._starters:
+                thread.join()
+            # Last first, so its captured output is read while the rest finish
+            for cmd in reversed(self.commands):
+                if cmd.proc:
                     cmd.wait()
+            for thread in self._copiers:
+                thread.join()
+        except KeyboardInterrupt:
+            self.kill()
+            raise KeyboardInterrupt
+        self.returncodes = [cmd.proc.returncode if cmd.proc else None
+                            for cmd in self.commands]
+        return self.returncodes[-1]
+
+
+    def kill(self):
+        """Kill every command in the pipeline that is still running, and
+        stop any that are waiting on a named pipe from starting.
+        """
+        with self._lock:
+            self._killed = True
+        # Open the other end of any named pipe a command is waiting on,
+        # so its starter thread can see it is not wanted
+        for path, flags in self._fifos:
+            try:
+                os.close(os.open(path, flags | os.O_NONBLOCK))
+            except OSError:
+                pass
+        for cmd in self.commands:
+            if cmd.proc and not cmd.done():
+                cmd.kill()
+
+
+    def done(self):
+        """Return ``True`` if every command in the pipeline is finished
+        running; ``False`` otherwise.
+        """
+        if any(thread.is_alive() for thread in self._starters):
+            return False
+        return all(cmd.done() for cmd in self.commands if cmd.proc)
+
+
+    def run_async(self, capture=False, background=False):
+        """Return a coroutine that runs the pipeline like `run`, without
+        blocking the event loop (Python 3 only). Awaiting it returns the exit
+        status of the last command, or ``None`` if ``background=True``
+        (then await `wait_async`).
+        """
+        from libtovid import aiocli
+        return aiocli.run_pipe(self, capture, background)
+
+
+    def wait_async(self):
+        """Return a coroutine that waits for a pipeline started by
+        `run_async` to finish, and returns the exit status of the last
+        command.
+        """
+        from libtovid import aiocli
+        return aiocli.wait_pipe(self)
 
 
     def get_output(self):
@@ -327,10 +667,557 @@ class Pipe:
     def __str__(self):
         """Return a string representation of the Pipe.
         """
-        commands = [unicode(cmd) for cmd in self.commands]
+        commands = []
+        for cmd in self.commands:
+            commands.append(unicode(cmd))
+            for tee_cmd, filename in self._tees:
+                if tee_cmd is cmd:
+                    commands.append("tee %s" % _enc_arg(filename))
         return ' | '.join(commands)
 
 
+    def _start(self, cmd, stdin, stdout):
+        """Start ``cmd`` reading from ``stdin`` and writing to ``stdout``, and
+        close our copies of any pipe descriptors handed to it. Commands
+        reading or writing a named pipe are started in a background thread.
+        """
+        fifos = []
+        if _is_fifo(stdin):
+            fifos.append((stdin, os.O_WRONLY))
+        if _is_fifo(stdout):
+            fifos.append((stdout, os.O_RDONLY))
+        if fifos:
+            self._fifos.extend(fifos)
+            thread = threading.Thread(target=self._start_now,
+                                      args=(cmd, stdin, stdout))
+            thread.daemon = True
+            thread.start()
+            self._starters.append(thread)
+        else:
+            self._start_now(cmd, stdin, stdout)
+
+
+    def _start_now(self, cmd, stdin, stdout):
+        """Open ``stdin`` and ``stdout`` (if they are filenames), then start
+        ``cmd``, teeing its output if needed. See `_start`.
+        """
+        tee_files = [name for tee_cmd, name in self._tees if tee_cmd is cmd]
+        to_close = []
+        source = None
+        try:
+            if isinstance(stdin, basestring):
+                stdin = os.open(stdin, os.O_RDONLY)
+                to_close.append(stdin)
+            elif _is_fd(stdin) and stdin not in self._caller_fds:
+                to_close.append(stdin)
+            target = stdout
+            if tee_files and stdout is not subprocess.PIPE:
+                # Copy the output to its destination and the tee files
+                source, stdout = os.pipe()
+                to_close.append(stdout)
+                if target is None:
+                    target = os.dup(sys.stdout.fileno())
+                elif target in self._caller_fds:
+                    target = os.dup(target)
+                elif not isinstance(target, (int, basestring)):
+                    target = os.dup(target.fileno())
+            elif isinstance(stdout, basestring):
+                stdout = os.open(stdout, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                 438) # 0666
+                to_close.append(stdout)
+            elif _is_fd(stdout) and stdout not in self._caller_fds:
+                to_close.append(stdout)
+            with self._lock:
+                if self._killed:
+                    if source is not None:
+                        to_close.append(source)
+                    return
+                cmd.run_redir(stdin, stdout, None)
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        tees = [open(name, 'wb') for name in tee_files]
+        if stdout is subprocess.PIPE:
+            cmd._captures['stdout'].tees = tees
+        elif tees:
+            copier = threading.Thread(target=_copy,
+                                      args=(source, target, tees))
+            copier.daemon = True
+            copier.start()
+            self._copiers.append(copier)
+
+
+class JobCancelled (Exception):
+    """Raised by `Job.result` for a job that was cancelled before finishing.
+    """
+    pass
+
+
+class Job:
+    """A `Command` or `Pipe` added to a `Scheduler`, and its state.
+
+    A Job is a simple future: check on it with `done`, `succeeded` and
+    `failed`, get its exit status with `result`, or have a function called
+    with it when it finishes with `add_done_callback`.
+    """
+    # States
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, scheduler, task, after, capture):
+        self.scheduler = scheduler
+        self.task = task
+        self.after = list(after)
+        self.capture = capture
+        self.state = Job.PENDING
+        self.returncode = None
+        self.exception = None
+        self._callbacks = []
+        self._finished = threading.Event()
+
+
+    def done(self):
+        """Return ``True`` if the job has finished, failed or been cancelled.
+        """
+        return self.state in (Job.SUCCEEDED, Job.FAILED, Job.CANCELLED)
+
+
+    def succeeded(self):
+        """Return ``True`` if the job ran and exited with status 0.
+        """
+        return self.state == Job.SUCCEEDED
+
+
+    def failed(self):
+        """Return ``True`` if the job exited with a non-zero status or could
+        not be started.
+        """
+        return self.state == Job.FAILED
+
+
+    def cancelled(self):
+        """Return ``True`` if the job was cancelled.
+        """
+        return self.state == Job.CANCELLED
+
+
+    def result(self, timeout=None):
+        """Wait for the job to finish, and return its exit status.
+
+            timeout
+                Seconds to wait, or ``None`` to wait as long as it takes
+
+        Raises `JobCancelled` if the job was cancelled, or the exception that
+        kept it from starting (such as `ProgramNotFound`).
+        """
+        if not self._finished.wait(timeout) and not self.done():
+            return None
+        if self.state == Job.CANCELLED:
+            raise JobCancelled("Cancelled: %s" % self.task)
+        if self.exception:
+            raise self.exception
+        return self.returncode
+
+
+    def add_done_callback(self, callback):
+        """Call ``callback(job)`` when the job finishes, fails or is cancelled
+        (or right away, if it already has). Callbacks are called from the
+        thread running the `Scheduler`.
+        """
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+
+    def cancel(self):
+        """Cancel the job, killing it if it is running. Jobs depending on it
+        are cancelled too.
+        """
+        self.scheduler.cancel(self)
+
+
+    def __str__(self):
+        return "%s: %s" % (self.state, self.task)
+
+
+class Scheduler:
+    """Run many `Command` and `Pipe` objects, several at a time, each one
+    starting once all the jobs it depends on have succeeded.
+
+    For example, to make two thumbnails at once and then a montage of them::
+
+        >>> jobs = Scheduler(max_jobs=2)
+        >>> thumb1 = jobs.add(Command('convert', 'a.png', '-resize', '25%', 'a.jpg'))
+        >>> thumb2 = jobs.add(Command('convert', 'b.png', '-resize', '25%', 'b.jpg'))
+        >>> both = jobs.add(Command('montage', 'a.jpg', 'b.jpg', 'ab.jpg'),
+        ...                 after=[thumb1, thumb2])
+        >>> jobs.run()                                # doctest: +SKIP
+        True
+
+    If a job fails, the jobs that depend on it are cancelled, and (unless
+    ``keep_going`` is set) so is every job that hasn't started yet; jobs
+    already running are left to finish.
+    """
+    def __init__(self, max_jobs=None, keep_going=False):
+        """Create a Scheduler.
+
+            max_jobs
+                How many jobs may run at once; by default, the number of CPUs
+            keep_going
+                ``False`` to stop starting new jobs when one fails,
+                ``True`` to only cancel the jobs depending on it
+        """
+        self.max_jobs = max_jobs or cpu_count()
+        self.keep_going = keep_going
+        self.jobs = []
+        self._lock = threading.Condition()
+        self._finished = []
+        self._thread = None
+
+
+    def add(self, task, after=None, capture=False, callback=None):
+        """Add a `Command` or `Pipe` to be run, and return its `Job`.
+
+            task
+                The `Command` or `Pipe` to run
+            after
+                A list of Jobs (from this Scheduler) that must succeed
+                before this one starts
+            capture
+                ``True`` to capture output for the task's `get_output`
+            callback
+                Function to call with the Job when it is done
+                (see `Job.add_done_callback`)
+        """
+        after = after or []
+        for job in after:
+            if job not in self.jobs:
+                raise ValueError("%s is not a job in this Scheduler" % job)
+        job = Job(self, task, after, capture)
+        if callback:
+            job.add_done_callback(callback)
+        with self._lock:
+            self.jobs.append(job)
+            self._lock.notify()
+        return job
+
+
+    def run(self):
+        """Run all the jobs, and return ``True`` if every one succeeded.
+
+        If a :exc:`KeyboardInterrupt` occurs, all jobs are cancelled (and
+        :exc:`KeyboardInterrupt` re-raised).
+        """
+        try:
+            with self._lock:
+                while not all(job.done() for job in self.jobs):
+                    self._finish_jobs()
+                    self._start_jobs()
+                    if all(job.done() for job in self.jobs):
+                        break
+                    # Nothing can start until something finishes
+                    if not self._running():
+                        self._cancel_blocked()
+                        continue
+                    self._lock.wait()
+                self._finish_jobs()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise KeyboardInterrupt
+        return all(job.succeeded() for job in self.jobs)
+
+
+    def start(self):
+        """Run all the jobs in a background thread. Use `wait` to wait for
+        them, or the Jobs' callbacks to hear about them as they finish.
+        """
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def wait(self):
+        """Wait for jobs started by `start` to finish, and return ``True`` if
+        every one succeeded.
+        """
+        if self._thread:
+            self._thread.join()
+        return all(job.succeeded() for job in self.jobs)
+
+
+    def cancel(self, job=None):
+        """Cancel the given job (and those depending on it), or every job if
+        none is given. Running jobs are killed.
+        """
+        with self._lock:
+            if job:
+                self._cancel(job)
+            else:
+                for job in self.jobs:
+                    self._cancel(job)
+            self._lock.notify()
+
+
+    def _running(self):
+        """Return the number of jobs currently running."""
+        return len([job for job in self.jobs if job.state == Job.RUNNING])
+
+
+    def _start_jobs(self):
+        """Start as many ready jobs as ``max_jobs`` allows."""
+        for job in self.jobs:
+            if self._running() >= self.max_jobs:
+                return
+            if job.state != Job.PENDING:
+                continue
+            if not all(dep.succeeded() for dep in job.after):
+                continue
+            try:
+                if isinstance(job.task, Pipe):
+                    job.task.run(capture=job.capture, background=True)
+                else:
+                    job.task.run(capture=job.capture, background=True,
+                                 silent=True)
+            except Exception as exception:
+                job.exception = exception
+                self._done(job, Job.FAILED)
+                continue
+            job.state = Job.RUNNING
+            waiter = threading.Thread(target=self._wait, args=(job,))
+            waiter.daemon = True
+            waiter.start()
+
+
+    def _wait(self, job):
+        """Wait for a running job (in its own thread), and hand it back to
+        the scheduling thread.
+        """
+        returncode = job.task.wait()
+        with self._lock:
+            job.returncode = returncode
+            self._finished.append(job)
+            self._lock.notify()
+
+
+    def _finish_jobs(self):
+        """Record the results of jobs whose processes have exited."""
+        while self._finished:
+            job = self._finished.pop(0)
+            if job.state != Job.RUNNING:
+                continue # cancelled while running
+            if job.returncode == 0:
+                self._done(job, Job.SUCCEEDED)
+            else:
+                self._done(job, Job.FAILED)
+
+
+    def _done(self, job, state):
+        """Put a job in its final state, cancel whatever its failure blocks,
+        and call its callbacks.
+        """
+        job.state = state
+        if state == Job.FAILED:
+            if self.keep_going:
+                self._cancel_dependents(job)
+            else:
+                for other in self.jobs:
+                    if other.state == Job.PENDING:
+                        self._cancel(other)
+        job._finished.set()
+        for callback in job._callbacks:
+            callback(job)
+
+
+    def _cancel(self, job):
+        """Cancel a job and the jobs depending on it."""
+        if job.done():
+            return
+        if job.state == Job.RUNNING:
+            job.task.kill()
+        self._done(job, Job.CANCELLED)
+        self._cancel_dependents(job)
+
+
+    def _cancel_dependents(self, job):
+        """Cancel every job depending, directly or not, on the given job."""
+        for other in self.jobs:
+            if job in other.after:
+                self._cancel(other)
+
+
+    def _cancel_blocked(self):
+        """Cancel pending jobs that can never start, since something they
+        depend on did not succeed.
+        """
+        for job in self.jobs:
+            if job.state == Job.PENDING and \
+               any(dep.done() and not dep.succeeded() for dep in job.after):
+                self._cancel(job)
+
+
+def cpu_count():
+    """Return the number of CPUs, or 1 if it can't be determined."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class _Capture:
+    """Output captured from one stream of a running command.
+
+    At most ``limit`` bytes are held in memory (all of it, if ``limit`` is
+    ``None``). Once the stream outgrows that, everything read so far and
+    from then on goes to a temporary file, and only the last ``limit`` bytes
+    are kept in memory.
+    """
+    def __init__(self, limit=None, prefix='command'):
+        self.limit = limit
+        self.prefix = prefix
+        self.buffer = bytearray()
+        self.filename = None
+        self.spill = None
+        self.tees = []
+        self.done = False
+
+
+    def write(self, data):
+        """Capture a chunk of data read from the stream."""
+        self.buffer += data
+        for tee in self.tees:
+            tee.write(data)
+        if self.spill:
+            self.spill.write(data)
+        elif self.limit is not None and len(self.buffer) > self.limit:
+            # Lazy import; libtovid.util needs libtovid.Config
+            from libtovid.util import temp_file
+            self.filename = temp_file(os.path.basename(self.prefix), '.log')
+            self.spill = open(self.filename, 'wb')
+            self.spill.write(self.buffer)
+        if self.limit is not None and len(self.buffer) > self.limit:
+            del self.buffer[:len(self.buffer) - self.limit]
+
+
+    def read_from(self, stream):
+        """Yield (and capture) chunks of data from ``stream`` as they arrive,
+        until end of file. Reads straight from the file descriptor, so data is
+        seen as soon as it is written rather than when a buffer fills.
+        """
+        if self.done:
+            return
+        fd = stream.fileno()
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            self.write(data)
+            yield data
+        stream.close()
+        if self.spill:
+            self.spill.close()
+        for tee in self.tees:
+            tee.close()
+        self.done = True
+
+
+    def drain(self, stream):
+        """Capture everything remaining in ``stream``."""
+        for data in self.read_from(stream):
+            pass
+
+
+    def getvalue(self):
+        """Return the captured data (or its last ``limit`` bytes)."""
+        return bytes(self.buffer)
+
+
+class _LineSplitter:
+    """Split byte chunks, fed in as they arrive, into unicode lines ending in
+    ``\\n``, ``\\r`` or ``\\r\\n``.
+    """
+    def __init__(self):
+        self.pending = b''
+
+
+    def feed(self, data):
+        """Add a chunk of data, and return a list of the lines it completes."""
+        pending = self.pending + data
+        # A trailing \r may be the first half of \r\n; wait for more
+        hold = pending.endswith(b'\r')
+        if hold:
+            pending = pending[:-1]
+        lines = re.split(b'\r\n|\r|\n', pending)
+        self.pending = lines.pop() + (b'\r' if hold else b'')
+        return [line.decode('utf-8', 'replace') for line in lines]
+
+
+    def close(self):
+        """Return a list holding the last, unterminated line (if any)."""
+        pending = self.pending.rstrip(b'\r')
+        self.pending = b''
+        if pending:
+            return [pending.decode('utf-8', 'replace')]
+        return []
+
+
+def _split_lines(chunks):
+    """Yield unicode lines from an iterable of byte chunks, splitting on
+    ``\\n``, ``\\r`` or ``\\r\\n``.
+    """
+    splitter = _LineSplitter()
+    for data in chunks:
+        for line in splitter.feed(data):
+            yield line
+    for line in splitter.close():
+        yield line
+
+
+def _is_fd(stream):
+    """Return ``True`` if ``stream`` is a file descriptor (and not one of the
+    negative ``subprocess.PIPE``-like constants).
+    """
+    return isinstance(stream, int) and stream >= 0
+
+
+def _is_fifo(name):
+    """Return ``True`` if ``name`` is the filename of a named pipe."""
+    return isinstance(name, basestring) and os.path.exists(name) and \
+           stat.S_ISFIFO(os.stat(name).st_mode)
+
+
+def _copy(source, target, tees):
+    """Copy everything from the file descriptor ``source`` to ``target`` (a
+    file descriptor, or a filename to open) and to each of the ``tees`` file
+    objects, then close them all.
+    """
+    try:
+        if isinstance(target, basestring):
+            target = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             438) # 0666
+        while True:
+            data = os.read(source, 1048576)
+            if not data:
+                break
+            for tee in tees:
+                tee.write(data)
+            while data:
+                data = data[os.write(target, data):]
+    except OSError:
+        # The reader went away; closing our end passes that upstream
+        pass
+    finally:
+        os.close(source)
+        if isinstance(target, int):
+            os.close(target)
+        for tee in tees:
+            tee.close()
+
+
 def _enc_arg(arg):
     """Quote an argument for proper handling of special shell characters.
     Don't quote unless necessary. For example:
@@ -0,0 +1,95 @@
+"""Estimate how hard videos are to compress, so the space on a disc can be
+shared between them by how much they need, not only by how long they are.
+
+A few short samples of each video are encoded at a small size with a fixed
+quantizer. The bytes per second that takes is the video's complexity: the
+same quality costs about that much more (or less) bitrate in the full
+encode. For example::
+
+    >>> length = video_length('/videos/one.avi')           # doctest: +SKIP
+    >>> complexity('/videos/one.avi', length)              # doctest: +SKIP
+    15360.0
+
+`complexities` does this for many videos, and is what
+`libtovid.util.playtime.fit_titles` takes as its ``weights``.
+"""
+
+__all__ = [
+    'video_length',
+    'complexity',
+    'complexities',
+]
+
+import os
+import tempfile
+
+from libtovid import cli
+
+# Samples taken from each video, and their length in seconds
+SAMPLES = 3
+SAMPLE_SECONDS = 4
+# Size to encode the samples at, and the fixed quantizer to use
+SAMPLE_SIZE = '176:144'
+SAMPLE_QUANT = '4'
+
+
+def video_length(filename, ffprobe='ffprobe'):
+    """Return the length of a video file in seconds, as ffprobe finds it, or
+    0 if it can't be found.
+    """
+    probe = cli.Command(ffprobe, '-v', 'error', '-show_entries',
+                        'format=duration', '-of', 'default=nw=1:nk=1',
+                        filename)
+    probe.run(capture=True, silent=True)
+    try:
+        return float(probe.get_output())
+    except ValueError:
+        return 0
+
+
+def complexity(filename, length, ffmpeg='ffmpeg'):
+    """Return the bytes per second ``filename`` takes in a quick encode of
+    a few samples at low resolution and a fixed quantizer, or ``None`` if
+    it could not be encoded.
+
+        filename
+            Video file to sample
+        length
+            Its length in seconds; the samples are spread evenly over it
+    """
+    fd, sample = tempfile.mkstemp(prefix='tovid_sample_', suffix='.m2v')
+    os.close(fd)
+    total_size = 0
+    total_seconds = 0
+    try:
+        for index in range(SAMPLES):
+            start = length * (index + 0.5) / SAMPLES - SAMPLE_SECONDS / 2.0
+            seconds = min(SAMPLE_SECONDS, length)
+            encode = cli.Command(ffmpeg, '-v', 'error',
+                                 '-ss', '%.2f' % max(start, 0),
+                                 '-i', filename, '-t', '%.2f' % seconds,
+                                 '-an', '-sn', '-vf', 'scale=' + SAMPLE_SIZE,
+                                 '-c:v', 'mpeg2video', '-q:v', SAMPLE_QUANT,
+                                 '-f', 'mpeg2video', '-y', sample)
+            encode.run(capture=True, background=True, silent=True)
+            if encode.wait() != 0:
+                continue
+            total_size += os.path.getsize(sample)
+            total_seconds += seconds
+    finally:
+        os.remove(sample)
+    if total_size == 0:
+        return None
+    return float(total_size) / total_seconds
+
+
+def complexities(filenames, lengths, ffmpeg='ffmpeg'):
+    """Return the complexity of each video file, for weighting bitrates.
+    Files that could not be sampled get the average of the others (or
+    ``1.0``, if none could be sampled).
+    """
+    found = [complexity(filename, length, ffmpeg)
+             for filename, length in zip(filenames, lengths)]
+    known = [value for value in found if value]
+    average = sum(known) / len(known) if known else 1.0
+    return [value or average for value in found]
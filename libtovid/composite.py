@@ -0,0 +1,386 @@
+"""Composite the frames of a ``todisc`` menu in one process, with Pillow.
+
+``todisc`` builds each frame of an animated menu from thumbnails of the
+videos, a background, a title and (optionally) a mist behind the title and
+play-all or return buttons. Doing that with ImageMagick takes a ``montage``
+and several ``composite`` and ``convert`` commands for every frame, plus the
+images they pass between them. A `MenuCompositor` reads the parts that don't
+change once, then tiles and dissolves each frame in memory and writes it out
+as a binary PPM, ready for ``ppmtoy4m``.
+
+The frames are described one per line, with tab-separated fields::
+
+    frame BACKGROUND BG% THUMBS% MIST% TITLE% BUTTONS% THUMB1 THUMB2 ...
+    repeat COUNT
+
+where the percentages are the opacity each part is dissolved with, as for
+``composite -dissolve`` (the background is dissolved onto black), and
+``repeat`` writes the last frame again ``COUNT`` times. For example::
+
+    >>> menu = MenuCompositor('3x2', '200x150+12+6', 'north', '+0+45')
+    >>> menu.add_overlay('title', 'title.png', 'south', '+0+50') # doctest: +SKIP
+    >>> menu.run(open('frames.txt'), sys.stdout)        # doctest: +SKIP
+
+Positions follow ImageMagick's ``-gravity`` and ``-geometry`` rules, and the
+thumbnails are tiled as ``montage -tile -geometry -background none`` does.
+
+A `Slideshow` writes the frames of an animated slideshow menu the same way,
+from lines like these::
+
+    still SLIDE COUNT
+    fadein SLIDE COUNT
+    fadeout SLIDE COUNT
+    crossfade SLIDE NEXT_SLIDE COUNT
+    black COUNT
+
+Each slide is read once, each transition frame is a single blend of two
+whole images, and a still is the same frame written ``COUNT`` times.
+"""
+
+__all__ = [
+    'MenuCompositor',
+    'Slideshow',
+    'parse_geometry',
+    'gravity_position',
+]
+
+import re
+from PIL import Image
+
+# Kinds of overlay, and so which opacity in a frame line applies to them
+OVERLAYS = ('mist', 'title', 'button')
+# Colour slides fade in from and out to (as todisc's black.ppm)
+BLACK = (16, 16, 16)
+
+
+def parse_geometry(geometry):
+    """Return ``(width, height, x, y)`` from an ImageMagick-style geometry
+    such as ``200x150+12+6``, ``+0+45`` or ``200x150``. Missing values are
+    ``None`` (for the size) or 0 (for the offsets).
+
+        >>> parse_geometry('200x150+12+6')
+        (200, 150, 12, 6)
+        >>> parse_geometry('+50-20')
+        (None, None, 50, -20)
+    """
+    match = re.match(r'^(?:(\d+)x(\d+))?(?:([+-]\d+)([+-]\d+))?$',
+                     geometry.strip())
+    if not match:
+        raise ValueError("Invalid geometry: '%s'" % geometry)
+    width, height, x, y = match.groups()
+    return (width and int(width), height and int(height),
+            int(x or 0), int(y or 0))
+
+
+def gravity_position(gravity, size, item_size, offset):
+    """Return the ``(x, y)`` position of an image of ``item_size`` placed on
+    one of ``size`` with the given ``gravity`` and ``(x, y)`` offset.
+
+        >>> gravity_position('SouthEast', (720, 480), (100, 50), (50, 80))
+        (570, 350)
+        >>> gravity_position('north', (720, 480), (100, 50), (0, 45))
+        (310, 45)
+    """
+    gravity = gravity.lower()
+    width, height = size
+    item_width, item_height = item_size
+    x, y = offset
+    if gravity.endswith('east'):
+        x = width - item_width - x
+    elif not gravity.endswith('west'):
+        x = (width - item_width) // 2 + x
+    if gravity.startswith('south'):
+        y = height - item_height - y
+    elif not gravity.startswith('north'):
+        y = (height - item_height) // 2 + y
+    return (x, y)
+
+
+class MenuCompositor:
+    """Composites menu frames from thumbnails, a background and overlays.
+    """
+    def __init__(self, tile, geometry, gravity, offset):
+        """Create a compositor that tiles the thumbnails of each frame.
+
+            tile
+                Columns and rows of thumbnails, like ``3x2``
+            geometry
+                Size of each thumbnail and the space around it, like
+                ``200x150+12+6``
+            gravity
+                Gravity to place the tiled thumbnails on the background with
+            offset
+                Offset from the gravity, like ``+0+45``
+        """
+        self.columns, self.rows = [int(n) for n in tile.split('x')]
+        width, height, self.pad_x, self.pad_y = parse_geometry(geometry)
+        self.thumb_size = (width, height)
+        self.gravity = gravity
+        self.offset = parse_geometry(offset)[2:]
+        self.overlays = []
+        self._background = (None, None)
+        self._montage = (None, None)
+        self._last = None
+
+
+    def add_overlay(self, kind, filename, gravity, offset):
+        """Add an image to put over every frame, after the thumbnails.
+
+            kind
+                'mist', 'title' or 'button'; says which opacity applies
+            filename
+                Image file to overlay
+            gravity, offset
+                Where to place it, as for ``composite``
+        """
+        if kind not in OVERLAYS:
+            raise ValueError("Unknown overlay '%s'" % kind)
+        image = _load(filename)
+        self.overlays.append((kind, image, gravity,
+                              parse_geometry(offset)[2:]))
+        # The mist goes under the title
+        self.overlays.sort(key=lambda overlay: OVERLAYS.index(overlay[0]))
+
+
+    def montage(self, thumbs):
+        """Return the given thumbnail images tiled as ``montage`` would, on a
+        transparent background.
+        """
+        if thumbs == self._montage[0]:
+            return self._montage[1]
+        width, height = self.thumb_size
+        cell_width = width + 2 * self.pad_x
+        cell_height = height + 2 * self.pad_y
+        rows = min(self.rows, (len(thumbs) + self.columns - 1) // self.columns)
+        image = Image.new('RGBA', (self.columns * cell_width,
+                                   max(1, rows) * cell_height), (0, 0, 0, 0))
+        for index, filename in enumerate(thumbs[:self.columns * self.rows]):
+            thumb = _fit(_load(filename), self.thumb_size)
+            column, row = index % self.columns, index // self.columns
+            x = column * cell_width + (cell_width - thumb.size[0]) // 2
+            y = row * cell_height + (cell_height - thumb.size[1]) // 2
+            _over(image, thumb, (x, y))
+        # Static menus use the same thumbnails for every frame
+        self._montage = (list(thumbs), image)
+        return image
+
+
+    def frame(self, background, opacities, thumbs):
+        """Return one frame of the menu, as an RGB image.
+
+            background
+                Background image file
+            opacities
+                Dict of the percent opacity of the 'background', 'thumbs',
+                'mist', 'title' and 'button' parts
+            thumbs
+                Thumbnail image files, in the order they are tiled
+        """
+        if background != self._background[0]:
+            self._background = (background, _load(background))
+        image = _darken(self._background[1], opacities['background'])
+        if thumbs:
+            montage = self.montage(thumbs)
+            position = gravity_position(self.gravity, image.size,
+                                        montage.size, self.offset)
+            _over(image, _dissolve(montage, opacities['thumbs']), position)
+        for kind, overlay, gravity, offset in self.overlays:
+            position = gravity_position(gravity, image.size,
+                                        overlay.size, offset)
+            _over(image, _dissolve(overlay, opacities[kind]), position)
+        return image.convert('RGB')
+
+
+    def run(self, infile, outfile):
+        """Read frame lines from ``infile`` and write each frame as a binary
+        PPM to ``outfile``, and return the number of frames written.
+        """
+        count = 0
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'frame' and len(fields) >= 7:
+                opacities = dict(zip(('background', 'thumbs') + OVERLAYS,
+                                     [float(value) for value in fields[2:7]]))
+                image = self.frame(fields[1], opacities, fields[7:])
+                self._last = _ppm(image)
+                outfile.write(self._last)
+                count += 1
+            elif fields[0] == 'repeat' and len(fields) == 2 and self._last:
+                for repeat in range(int(fields[1])):
+                    outfile.write(self._last)
+                    count += 1
+            elif line.strip():
+                raise ValueError("Invalid frame line: '%s'" % line.strip())
+        outfile.flush()
+        return count
+
+
+class Slideshow:
+    """Writes the frames of a slideshow, with fades and crossfades between
+    the slides, as a stream of PPM frames.
+    """
+    def __init__(self, outfile):
+        """Create a slideshow writing to ``outfile``."""
+        self.outfile = outfile
+        self.count = 0
+        # The slides being faded between, by filename
+        self._slides = {}
+        self._size = None
+
+
+    def slide(self, filename):
+        """Return the slide image in ``filename`` as RGB, reading it only if
+        it isn't one of the slides last used.
+        """
+        if filename not in self._slides:
+            # Only the slides either side of a transition are needed
+            if len(self._slides) > 2:
+                self._slides.clear()
+            self._slides[filename] = Image.open(filename).convert('RGB')
+        self._size = self._slides[filename].size
+        return self._slides[filename]
+
+
+    def still(self, slide, count):
+        """Write ``count`` frames of ``slide``."""
+        self._write(_ppm(self.slide(slide)), count)
+
+
+    def black(self, count):
+        """Write ``count`` black frames, the size of the last slide."""
+        if self._size:
+            self._write(_ppm(Image.new('RGB', self._size, BLACK)), count)
+
+
+    def fadein(self, slide, count):
+        """Fade ``slide`` in from black over ``count`` frames, starting with
+        a black frame.
+        """
+        image = self.slide(slide)
+        black = Image.new('RGB', image.size, BLACK)
+        for index in range(count):
+            self._write(_ppm(Image.blend(black, image, float(index) / count)))
+
+
+    def fadeout(self, slide, count):
+        """Fade ``slide`` out to black over ``count`` frames, ending with a
+        black frame.
+        """
+        image = self.slide(slide)
+        black = Image.new('RGB', image.size, BLACK)
+        for index in range(count):
+            self._write(_ppm(Image.blend(image, black,
+                                         float(index + 1) / count)))
+
+
+    def crossfade(self, slide, next_slide, count):
+        """Fade from ``slide`` to ``next_slide`` over ``count`` frames, ending
+        with ``next_slide``.
+        """
+        image = self.slide(slide)
+        next_image = self.slide(next_slide)
+        if next_image.size != image.size:
+            next_image = next_image.resize(image.size, Image.BICUBIC)
+        for index in range(count):
+            self._write(_ppm(Image.blend(image, next_image,
+                                         float(index + 1) / count)))
+
+
+    def run(self, infile):
+        """Write the frames described by the lines of ``infile``, and return
+        the number of frames written.
+        """
+        for line in infile:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            transition = TRANSITIONS.get(fields[0])
+            if not transition or len(fields) != transition[1] + 2 \
+               or not fields[-1].isdigit():
+                raise ValueError("Invalid slideshow line: '%s'" % line.strip())
+            transition[0](self, *(fields[1:-1] + [int(fields[-1])]))
+        self.outfile.flush()
+        return self.count
+
+
+    def _write(self, frame, count=1):
+        """Write a PPM ``frame`` ``count`` times."""
+        for repeat in range(count):
+            self.outfile.write(frame)
+        self.count += max(0, count)
+
+
+# Slideshow method for each kind of line, and how many slides it takes
+TRANSITIONS = {
+    'still': (Slideshow.still, 1),
+    'black': (Slideshow.black, 0),
+    'fadein': (Slideshow.fadein, 1),
+    'fadeout': (Slideshow.fadeout, 1),
+    'crossfade': (Slideshow.crossfade, 2),
+}
+
+
+def _ppm(image):
+    """Return ``image`` as a binary PPM."""
+    image = image.convert('RGB')
+    header = 'P6\n%d %d\n255\n' % image.size
+    return header.encode('ascii') + image.tobytes()
+
+
+def _load(filename):
+    """Read an image file, as RGBA."""
+    image = Image.open(filename)
+    return image.convert('RGBA')
+
+
+def _fit(image, size):
+    """Resize ``image`` to fit within ``size``, keeping its aspect ratio."""
+    if image.size == tuple(size):
+        return image
+    scale = min(float(size[0]) / image.size[0],
+                float(size[1]) / image.size[1])
+    return image.resize((max(1, int(image.size[0] * scale + 0.5)),
+                         max(1, int(image.size[1] * scale + 0.5))),
+                        Image.BICUBIC)
+
+
+def _dissolve(image, opacity):
+    """Return ``image`` with its alpha scaled to ``opacity`` percent, as for
+    ``composite -dissolve``.
+    """
+    if opacity >= 100:
+        return image
+    opacity = max(0.0, opacity) / 100.0
+    alpha = image.split()[3].point(lambda value: int(value * opacity + 0.5))
+    image = image.copy()
+    image.putalpha(alpha)
+    return image
+
+
+def _darken(image, opacity):
+    """Return a copy of ``image`` dissolved onto black at ``opacity`` percent.
+    """
+    if opacity >= 100:
+        return image.copy()
+    scale = max(0.0, opacity) / 100.0
+    red, green, blue, alpha = image.split()
+    channels = [band.point(lambda value: int(value * scale + 0.5))
+                for band in (red, green, blue)]
+    return Image.merge('RGBA', channels + [alpha])
+
+
+def _over(base, image, position):
+    """Composite ``image`` over ``base`` in place, at ``position``; whatever
+    falls outside ``base`` is cut off.
+    """
+    x, y = position
+    left, top = max(0, -x), max(0, -y)
+    right = min(image.size[0], base.size[0] - x)
+    bottom = min(image.size[1], base.size[1] - y)
+    if right <= left or bottom <= top:
+        return
+    box = (x + left, y + top, x + right, y + bottom)
+    region = base.crop(box)
+    region = Image.alpha_composite(region,
+                                   image.crop((left, top, right, bottom)))
+    base.paste(region, box[:2])
@@ -140,9 +140,10 @@ _softsubs_size = Number('Soft subtitles fontsize', '-softsubs-size', 0,
 _normalize = Flag('Normalize', '-normalize', False,
     'Analyze the audio stream and then normalize the volume of the audio. '
     'This is useful if the audio is too quiet or too loud, or you want to '
-    'make volume consistent for a bunch of videos. Similar to running '
-    'normalize without any parameters. The default is -12dB average level '
-    'with 0dB gain.')
+    'make volume consistent for a bunch of videos. Each track is measured '
+    'in a quick pass, then encoded with the gain that brings its average '
+    'level to -12dB (or the Amplitude level), held down so peaks do not '
+    'clip.')
 _downmix = Flag('Downmix', '-downmix', False,
     'Encode all audio tracks as stereo. This can save space on your DVD if '
     'your player only does stereo. The default behavior of tovid is to use the '
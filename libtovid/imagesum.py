@@ -0,0 +1,308 @@
+"""Checksum disc images as they are made, and check discs against them.
+
+While ``makedvd`` streams a disc image to a file or the burner, the same
+stream goes through an `ImageSum`. This keeps an md5 of the whole image, of
+each chunk of ``CHUNK_SECTORS`` sectors, and of each file in it (found from
+the ISO9660 directories, which mkisofs writes before the files)::
+
+    >>> sums = ImageSum()                                   # doctest: +SKIP
+    >>> sums.feed(image_data)                               # doctest: +SKIP
+    >>> sums.close()                                        # doctest: +SKIP
+    >>> sums.save('disc.sums')                              # doctest: +SKIP
+
+After burning, `verify` reads the disc (or image file) back once, with large
+sequential reads, and compares it chunk by chunk::
+
+    >>> report = verify('/dev/dvdrw', ImageSum.load('disc.sums'))
+    ...                                                     # doctest: +SKIP
+    >>> report.ok                                           # doctest: +SKIP
+    True
+
+Chunks that differ, or could not be read, are given as sector ranges, with
+the files they hold.
+"""
+
+__all__ = [
+    'ImageSum',
+    'Report',
+    'verify',
+]
+
+import time
+import struct
+import hashlib
+
+SECTOR = 2048
+# Sectors in each checksummed chunk (1 MiB)
+CHUNK_SECTORS = 512
+# Bytes read at once when verifying
+READ_SIZE = 8 * 1024 * 1024
+# Sector of the ISO9660 primary volume descriptor
+PVD_SECTOR = 16
+
+
+class _Extent:
+    """A file or directory in the image, and its checksum so far."""
+    def __init__(self, name, start, size, is_dir):
+        self.name = name
+        self.start = start
+        self.size = size
+        self.is_dir = is_dir
+        self.done = 0
+        self.md5 = hashlib.md5()
+        self.data = bytearray()
+
+    def feed(self, data):
+        """Checksum (or keep, for a directory) the file's part of ``data``."""
+        data = data[:self.size - self.done]
+        self.done += len(data)
+        self.md5.update(data)
+        if self.is_dir:
+            self.data.extend(data)
+
+
+class ImageSum:
+    """Checksums of a disc image: the whole image, each chunk of
+    ``CHUNK_SECTORS`` sectors, and each file in its ISO9660 filesystem.
+
+        sectors
+            length of the image in sectors
+        md5
+            md5 of the whole image (hex)
+        chunks
+            md5 of each chunk (hex)
+        files
+            list of (name, first sector, size in bytes, md5) for each file
+    """
+    def __init__(self):
+        self.sectors = 0
+        self.md5 = None
+        self.chunks = []
+        self.files = []
+        self._md5 = hashlib.md5()
+        self._chunk = hashlib.md5()
+        self._chunk_bytes = 0
+        self._bytes = 0
+        self._head = bytearray()
+        self._extents = []
+
+
+    def feed(self, data):
+        """Checksum the next ``data`` of the image."""
+        self._md5.update(data)
+        self._feed_extents(data)
+        while data:
+            take = CHUNK_SECTORS * SECTOR - self._chunk_bytes
+            self._chunk.update(data[:take])
+            self._chunk_bytes += len(data[:take])
+            data = data[take:]
+            if self._chunk_bytes == CHUNK_SECTORS * SECTOR:
+                self._end_chunk()
+
+
+    def close(self):
+        """Finish the checksums once the whole image has been fed."""
+        if self._chunk_bytes:
+            self._end_chunk()
+        self.md5 = self._md5.hexdigest()
+        self.sectors = (self._bytes + SECTOR - 1) // SECTOR
+        for extent in self._extents:
+            if not extent.is_dir and extent.done == extent.size:
+                self.files.append((extent.name, extent.start, extent.size,
+                                   extent.md5.hexdigest()))
+        self.files.sort(key=lambda item: item[1])
+
+
+    def files_in(self, first, last):
+        """Return the names of the files with data in sectors ``first`` to
+        ``last`` (inclusive).
+        """
+        return [name for name, start, size, md5 in self.files
+                if start <= last and
+                start + (size + SECTOR - 1) // SECTOR > first]
+
+
+    def save(self, filename):
+        """Write the checksums to ``filename``."""
+        out = open(filename, 'w')
+        try:
+            out.write("image %s %d\n" % (self.md5, self.sectors))
+            for index, chunk in enumerate(self.chunks):
+                out.write("chunk %d %s\n" % (index, chunk))
+            for name, start, size, md5 in self.files:
+                out.write("file %d %d %s %s\n" % (start, size, md5, name))
+        finally:
+            out.close()
+
+
+    @classmethod
+    def load(cls, filename):
+        """Return the `ImageSum` written to ``filename`` with `save`."""
+        sums = cls()
+        for line in open(filename):
+            fields = line.split(None, 4)
+            if not fields:
+                continue
+            if fields[0] == 'image':
+                sums.md5, sums.sectors = fields[1], int(fields[2])
+            elif fields[0] == 'chunk':
+                sums.chunks.append(fields[2])
+            elif fields[0] == 'file':
+                sums.files.append((fields[4].rstrip('\n'), int(fields[1]),
+                                   int(fields[2]), fields[3]))
+        return sums
+
+
+    def _end_chunk(self):
+        self.chunks.append(self._chunk.hexdigest())
+        self._chunk = hashlib.md5()
+        self._chunk_bytes = 0
+
+
+    def _feed_extents(self, data):
+        """Pass ``data`` to the files and directories it holds part of,
+        finding the root directory from the volume descriptor first.
+        """
+        start = self._bytes
+        self._bytes += len(data)
+        head = (PVD_SECTOR + 1) * SECTOR
+        if start < head:
+            self._head.extend(data[:head - start])
+            if len(self._head) == head:
+                self._read_pvd(self._head[PVD_SECTOR * SECTOR:])
+        # Directories read here add to the list as it is gone through
+        index = 0
+        while index < len(self._extents):
+            extent = self._extents[index]
+            index += 1
+            offset = extent.start * SECTOR + extent.done
+            # Skip those done, not reached yet, or whose data went by
+            # before they were found
+            if extent.done >= extent.size or offset >= self._bytes or \
+               offset < start:
+                continue
+            extent.feed(data[offset - start:])
+            if extent.is_dir and extent.done == extent.size:
+                self._read_dir(extent)
+
+
+    def _read_pvd(self, pvd):
+        if pvd[0] != 1 or bytes(pvd[1:6]) != b'CD001':
+            return
+        start, size = struct.unpack_from('<I4xI', bytes(pvd), 156 + 2)
+        self._extents.append(_Extent('', start, size, True))
+
+
+    def _read_dir(self, directory):
+        """Add the files and directories listed in ``directory``."""
+        data = bytes(directory.data)
+        offset = 0
+        while offset < len(data):
+            length = bytearray(data[offset:offset + 1])[0]
+            if length == 0:
+                # Records don't cross sectors; skip to the next one
+                offset = (offset // SECTOR + 1) * SECTOR
+                continue
+            start, size = struct.unpack_from('<I4xI', data, offset + 2)
+            flags = bytearray(data[offset + 25:offset + 26])[0]
+            name_len = bytearray(data[offset + 32:offset + 33])[0]
+            name = data[offset + 33:offset + 33 + name_len]
+            offset += length
+            # Skip '.' and '..'
+            if name in (b'\x00', b'\x01'):
+                continue
+            name = name.decode('latin-1').split(';')[0].rstrip('.')
+            if directory.name:
+                name = directory.name + '/' + name
+            self._extents.append(_Extent(name, start, size, bool(flags & 2)))
+
+
+class Report:
+    """The result of `verify`.
+
+        sectors
+            sectors that were to be checked
+        bytes_read
+            bytes read back
+        seconds
+            time the reading took
+        bad
+            list of (first, last) sector ranges that differ or could not be
+            read
+        errors
+            read errors met, as strings
+    """
+    def __init__(self, sectors):
+        self.sectors = sectors
+        self.bytes_read = 0
+        self.seconds = 0.0
+        self.bad = []
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.bad
+
+    @property
+    def throughput(self):
+        """Reading speed in MiB per second."""
+        if self.seconds <= 0:
+            return 0.0
+        return self.bytes_read / 1048576.0 / self.seconds
+
+    def add_bad(self, first, last):
+        """Add sectors ``first`` to ``last``, joining them to the last bad
+        range if they follow on from it.
+        """
+        if self.bad and self.bad[-1][1] + 1 == first:
+            self.bad[-1] = (self.bad[-1][0], last)
+        else:
+            self.bad.append((first, last))
+
+
+def verify(filename, sums, read_size=READ_SIZE, progress=None):
+    """Read the first ``sums.sectors`` sectors of ``filename`` (a disc
+    device or image file) in one sequential pass, and compare each chunk
+    with ``sums``. Return a `Report`.
+
+        read_size
+            bytes to read at once (a multiple of the chunk size)
+        progress
+            function called with the number of bytes read so far, after
+            each read
+    """
+    report = Report(sums.sectors)
+    total = sums.sectors * SECTOR
+    chunk_size = CHUNK_SECTORS * SECTOR
+    start_time = time.time()
+    try:
+        disc = open(filename, 'rb')
+    except (IOError, OSError) as err:
+        report.errors.append(str(err))
+        report.add_bad(0, sums.sectors - 1)
+        return report
+    try:
+        for first in range(0, total, read_size):
+            size = min(read_size, total - first)
+            try:
+                disc.seek(first)
+                data = disc.read(size)
+            except (IOError, OSError) as err:
+                # Skip the unreadable block, and carry on after it
+                report.errors.append("sector %d: %s" % (first // SECTOR, err))
+                data = b''
+            report.bytes_read += len(data)
+            for start in range(0, size, chunk_size):
+                index = (first + start) // chunk_size
+                chunk = data[start:start + chunk_size]
+                end = min(start + chunk_size, size)
+                if len(chunk) < end - start or index >= len(sums.chunks) or \
+                   hashlib.md5(chunk).hexdigest() != sums.chunks[index]:
+                    report.add_bad((first + start) // SECTOR,
+                                   (first + end + SECTOR - 1) // SECTOR - 1)
+            if progress:
+                progress(report.bytes_read)
+    finally:
+        disc.close()
+        report.seconds = time.time() - start_time
+    return report
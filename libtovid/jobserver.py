@@ -0,0 +1,124 @@
+"""Share the CPUs between all the jobs that one ``tovid`` command runs.
+
+The ``tovid`` frontend makes a jobserver: a FIFO holding a token (one byte)
+for each job beyond the first that may run at once, named in the
+``TOVID_JOBSERVER`` environment variable. Each script runs its own first
+job; every other job it runs at the same time takes a token first and gives
+it back when done. So however deeply the scripts run each other (``todisc``
+running ``todisc`` for titlesets, ``tovid batch`` running ``tovid mpg``),
+no more than the frontend's ``-jobs`` run in all. The shell scripts do the
+same with ``jobserver_take`` and ``jobserver_give`` from tovid-init.
+
+For example::
+
+    >>> server = Jobserver.create(4)                # doctest: +SKIP
+    >>> jobs = Jobserver()                          # doctest: +SKIP
+    >>> jobs.take(wait=False)                       # doctest: +SKIP
+    True
+    >>> jobs.give()                                 # doctest: +SKIP
+    >>> server.close()                              # doctest: +SKIP
+
+Without a jobserver (a script run on its own), every token asked for is
+given at once.
+"""
+
+__all__ = [
+    'Jobserver',
+]
+
+import os
+import errno
+import select
+import shutil
+import tempfile
+import threading
+
+# Environment variable naming the jobserver FIFO
+ENVIRON = 'TOVID_JOBSERVER'
+TOKEN = b'+'
+
+
+class Jobserver:
+    """A connection to a jobserver (by default the one named in
+    ``TOVID_JOBSERVER``, if any).
+    """
+    def __init__(self, path=None):
+        """Open the jobserver FIFO at ``path``, or the one named in the
+        environment. If there is none, tokens are always given.
+        """
+        self.path = path or os.environ.get(ENVIRON)
+        self.fd = None
+        self.held = 0
+        self._dir = None
+        self._lock = threading.Lock()
+        if self.path:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError:
+                self.path = None
+
+
+    @classmethod
+    def create(cls, jobs):
+        """Make a jobserver letting ``jobs`` jobs run at once, and name it in
+        the environment of the processes started from now on. ``close`` it
+        once they have finished.
+        """
+        directory = tempfile.mkdtemp(prefix='tovid-jobs.')
+        path = os.path.join(directory, 'jobserver')
+        os.mkfifo(path)
+        server = cls(path)
+        server._dir = directory
+        os.write(server.fd, TOKEN * max(0, jobs - 1))
+        os.environ[ENVIRON] = path
+        return server
+
+
+    def take(self, wait=True, timeout=None):
+        """Take a token, and return ``True``. If none is free, wait for one
+        (for up to ``timeout`` seconds, if given), or return ``False`` at once
+        if ``wait`` is false.
+        """
+        if self.fd is not None:
+            while True:
+                try:
+                    if os.read(self.fd, 1):
+                        break
+                except OSError as error:
+                    if error.errno != errno.EAGAIN:
+                        raise
+                if not wait:
+                    return False
+                ready = select.select([self.fd], [], [], timeout)[0]
+                if not ready:
+                    return False
+        with self._lock:
+            self.held += 1
+        return True
+
+
+    def give(self):
+        """Give back a token taken with ``take``.
+        """
+        with self._lock:
+            if self.held <= 0:
+                return
+            self.held -= 1
+        if self.fd is not None:
+            os.write(self.fd, TOKEN)
+
+
+    def close(self):
+        """Give back any tokens still held, and remove the jobserver if it
+        was made with ``create``.
+        """
+        while self.held:
+            self.give()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self._dir:
+            if os.environ.get(ENVIRON) == self.path:
+                del os.environ[ENVIRON]
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
@@ -292,3 +292,96 @@ class Bitrate:
         self.unit = 'GiBph'
         self.GiBph = bitrate
 
+
+
+def fit_titles(disc_size, lengths, audio_kbps=224, overhead=1.0,
+               reserved=0.0, max_kbps=None, weights=None):
+    """Share the space on a disc between titles of the given lengths, and
+    return an (AVstream, Bitrate) pair for each title: the size and length
+    of the title, and the video bitrate to encode it at.
+
+        disc_size
+            the space on the disc in MiB
+        lengths
+            the length of each title in seconds
+        audio_kbps
+            the audio bitrate of each title, in kbps (default = 224)
+        overhead
+            how much multiplexing adds to the size of each title, in percent
+            (default = 1.0)
+        reserved
+            MiB of the disc used by other things, like menus and titles that
+            are not being encoded (default = 0.0)
+        max_kbps
+            the highest video bitrate to use (default = no limit)
+        weights
+            how much bitrate each title needs compared to the others, such
+            as its complexity from `libtovid.complexity` (default = the
+            same for all)
+
+    For example, a two hour and a one hour title on a DVD with 100 MiB of
+    menus get the same video bitrate::
+
+        >>> titles = playtime.fit_titles(4300, [7200, 3600], reserved=100)
+        >>> [int(title.final_size) for title, video in titles]
+        [2800, 1400]
+        >>> [int(video.kbps) for title, video in titles]
+        [3005, 3005]
+
+    unless the one hour title is twice as hard to compress::
+
+        >>> titles = playtime.fit_titles(4300, [7200, 3600], reserved=100,
+        ...                              weights=[1, 2])
+        >>> [int(video.kbps) for title, video in titles]
+        [2254, 4508]
+
+    Titles that would get more than ``max_kbps`` are given ``max_kbps``, and
+    what they leave is shared between the others. If they all get
+    ``max_kbps``, the disc is left part empty::
+
+        >>> titles = playtime.fit_titles(4300, [1800], max_kbps=9000)
+        >>> int(titles[0][0].final_size)
+        1999
+        >>> titles[0][1].kbps
+        9000
+
+    Raises ValueError if there is no room left on the disc for video.
+    """
+    if sum(lengths) <= 0:
+        raise ValueError("The length of the titles is not known")
+    if weights is None:
+        weights = [1.0] * len(lengths)
+    factor = 1.0 + overhead / 100.0
+    disc = AVstream(sum(lengths) / 60.0, (disc_size - reserved) / factor)
+    # Kilobits left for video on the whole disc
+    video_kbits = (disc.bitrate.kbps - audio_kbps) * sum(lengths)
+    if video_kbits <= 0:
+        raise ValueError("%g MiB is not enough for %d seconds of audio and "
+                         "video" % (disc_size - reserved, sum(lengths)))
+    # Give each title bitrate by its weight, capping those that would get
+    # more than max_kbps until none do
+    capped = set()
+    while True:
+        free = [index for index in range(len(lengths)) if index not in capped]
+        if not free:
+            break
+        left = video_kbits - sum(max_kbps * lengths[index]
+                                 for index in capped)
+        per_weight = left / sum(weights[index] * lengths[index]
+                                for index in free)
+        over = [index for index in free
+                if max_kbps and per_weight * weights[index] > max_kbps]
+        if not over:
+            break
+        capped.update(over)
+    titles = []
+    for index, length in enumerate(lengths):
+        if index in capped:
+            video_kbps = max_kbps
+        else:
+            video_kbps = per_weight * weights[index]
+        title = AVstream(length / 60.0)
+        title.set_fixed_param('LENGTH')
+        title.set_bitrate((video_kbps + audio_kbps) * factor, 'kbps')
+        titles.append((title, Bitrate(video_kbps)))
+    return titles
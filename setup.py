@@ -243,11 +243,16 @@ setup(
             'src/todisc-fade-routine',
             'src/makempg',
             'src/mpv_identify.sh',
+            'src/ffprobe_identify',
             'src/tovid-init',
 
             # Python scripts
             'src/todiscgui',
             'src/tovid-stats',
+            'src/tovid-batch',
+            'src/todisc-composite',
+            'src/tovid-fit',
+            'src/tovid-verify',
             'src/titleset-wizard',
             'src/set_chapters',
 